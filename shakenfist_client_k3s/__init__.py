@@ -1,21 +1,10 @@
 import click
-import copy
-import json
-import os
-from pbr.version import VersionInfo
 from shakenfist_client import apiclient
-import subprocess
 import sys
-import tempfile
-import time
-import yaml
 
 from shakenfist_client_k3s import primitives
 
 
-CLUSTER_LIST = 'orchestrated_k3s_clusters'
-
-
 def _emit_debug(ctx, m):
     if ctx.obj['VERBOSE']:
         print(m)
@@ -33,12 +22,11 @@ def k3s():
                     'different namespace.'))
 @click.pass_context
 def k3s_list(ctx, namespace=None, ):
-    ctx.obj['CLIENT'] = apiclient.Client(async_strategy=apiclient.ASYNC_CONTINUE)
     if not namespace:
-        namespace = ctx.obj['CLIENT'].namespace
+        namespace = primitives.get_client(ctx).namespace
 
-    namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-    all_clusters = namespace_md.get(CLUSTER_LIST, [])
+    all_clusters = primitives.get_namespace_metadata_item(
+        ctx, namespace, primitives.CLUSTER_LIST, [])
 
     for cluster in all_clusters:
         print(cluster)
@@ -76,54 +64,49 @@ def k3s_create(ctx, name=None, control_plane_count=None, worker_count=None,
                metal_address_count=None,  namespace=None, network=None,
                refresh_version_cache=False, release_channel=None,
                sshkey=None):
+    # This import is only needed here, and is deferred so that it doesn't
+    # slow down the startup of the other, simpler commands.
+    from pbr.version import VersionInfo
+
+    client = primitives.get_client(ctx)
+    if namespace:
+        ns = client.get_namespace(namespace)
+        if not ns:
+            client.create_namespace(namespace)
+            print('Created namespace %s' % namespace)
+    else:
+        namespace = client.namespace
+
     ctx.obj['name'] = name
     ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(
-        async_strategy=apiclient.ASYNC_CONTINUE)
 
     _emit_debug(ctx, 'Looking up k3s versions')
     target_release = primitives.get_k3s_release(
         ctx, force_cache_update=refresh_version_cache,
         release_channel=release_channel)
 
-    if namespace:
-        ns = ctx.obj['CLIENT'].get_namespace(namespace)
-        if not ns:
-            ctx.obj['CLIENT'].create_namespace(namespace)
-            print('Created namespace %s' % namespace)
-    else:
-        namespace = ctx.obj['CLIENT'].namespace
-
-    # Ensure this name isn't already taken
-    namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-    all_clusters = namespace_md.get(CLUSTER_LIST, [])
-    md = primitives.get_cluster_metadata(ctx)
-
-    if name in all_clusters:
-        print('Sorry, that cluster name is already taken')
-        sys.exit(1)
-    if md:
+    # Ensure this name isn't already taken, and reserve it
+    try:
+        primitives.add_cluster_to_namespace(ctx, namespace, name)
+    except primitives.ClusterExistsException:
         print('Sorry, that cluster name is already taken')
         sys.exit(1)
-    all_clusters.append(name)
-    ctx.obj['CLIENT'].set_namespace_metadata_item(namespace, CLUSTER_LIST, all_clusters)
 
     # Create a network for nodes
     if network:
-        node_network = ctx.obj['CLIENT'].get_network(network)
+        node_network = client.get_network(network)
         if not node_network:
             print('Specified network does not exist')
             sys.exit(1)
     else:
-        node_network = ctx.obj['CLIENT'].allocate_network(
+        node_network = client.allocate_network(
             '10.0.0.0/16', True, True, 'k3s-%s-node' % name, namespace=namespace)
         print('Created %s as the node network (uuid %s)'
               % (node_network['name'], node_network['uuid']))
-        while True:
-            node_network = ctx.obj['CLIENT'].get_network(node_network['uuid'])
-            if node_network['state'] == 'created':
-                break
-            time.sleep(1)
+        network_uuid = node_network['uuid']
+        node_network = primitives.poll_until(
+            lambda: client.get_network(network_uuid),
+            lambda n: n['state'] == 'created', result=node_network)
         print('...Node network ready')
 
     # Read the ssh key if any
@@ -152,80 +135,62 @@ def k3s_create(ctx, name=None, control_plane_count=None, worker_count=None,
     }
     primitives.set_cluster_metadata(ctx, md)
 
-    # We really should do a pre-fetch on the disk image and wait for it to
-    # download before starting instances. That way the point of slowness is
-    # more obvious. That requires cluster operations to exist though.
-
-    # I'd prefer to wait for these as one thing, but that's not currently a thing
-    # the code supports.
-    print(f'Creating {control_plane_count} control plane nodes and '
-          f'{worker_count} worker nodes')
-    primitives.create_and_await_instances(
-        ctx, control_plane_count, 'control_plane')
-    primitives.create_and_await_instances(ctx, worker_count, 'worker')
-
-    # Record the node network address for the first control plane node as the API
-    # address
-    interfaces = ctx.obj['CLIENT'].get_instance_interfaces(md['control_plane_nodes'][0])
-    md['api_address_inner'] = interfaces[0]['ipv4']
-    md['api_address_floating'] = interfaces[0]['floating']
-    primitives.set_cluster_metadata(ctx, md)
-
-    print('Configuring and installing k3s control plane')
-    primitives.install_control_plane(ctx)
-
-    print('Installing workers')
-    primitives.install_workers(ctx)
-
-    # Fetch kubecfg, correct IP, and include cluster name instead of "default"
-    print('Fetching kubecfg for cluster')
-    aop = ctx.obj['CLIENT'].instance_get(
-        md['control_plane_nodes'][0], '/etc/rancher/k3s/k3s.yaml')
-    kubeconfig = primitives.await_fetch(ctx, aop).replace(
-        '127.0.0.1', md['api_address_floating'])
-
-    kc = yaml.safe_load(kubeconfig)
-    fqcn = '%s.%s' % (name, namespace)
-    kc['clusters'][0]['name'] = fqcn
-    kc['contexts'][0]['name'] = fqcn
-    kc['contexts'][0]['context']['cluster'] = fqcn
-    kc['contexts'][0]['context']['user'] = fqcn
-    kc['users'][0]['name'] = fqcn
-    kc['current-context'] = fqcn
-    md['kubeconfig'] = yaml.dump(kc)
-    primitives.set_cluster_metadata(ctx, md)
-
-    # Setup workers
-    primitives.install_workers(ctx)
-
-    # Install metallb and longhorn
-    primitives.setup_metallb(ctx, metal_address_count)
-    primitives.setup_longhorn(ctx)
-
-    # Fetch the kubeconfig and install it
-    with tempfile.TemporaryDirectory() as tempdir:
-        new_config_path = os.path.join(tempdir, 'config')
-        kube_dir = os.path.join(os.path.expanduser('~'), '.kube')
-        main_config_path = os.path.join(kube_dir, 'config')
-        os.makedirs(kube_dir, exist_ok=True)
-
-        with open(new_config_path, 'w') as f:
-            f.write(yaml.dump(kc))
-        p = subprocess.run(
-            'kubectl config view --flatten', shell=True, capture_output=True,
-            env={
-                'KUBECONFIG': ('%s/.kube/config:%s'
-                               % (os.path.expanduser('~'), new_config_path))
-                })
-        if p.returncode != 0:
-            print('Failed up update %s/.kube/config, return code %d'
-                  % (os.path.expanduser('~'), p.returncode))
-            sys.exit(1)
-        with open(main_config_path, 'wb') as f:
-            f.write(p.stdout)
-
-    md['state'] = 'created'
-    primitives.set_cluster_metadata(ctx, md)
+    # From here on metadata updates are only written out at checkpoints, and
+    # once at the end, rather than every time they change.
+    with primitives.defer_cluster_metadata(ctx):
+        # Fetch the disk image before starting instances, so that the point of
+        # slowness is more obvious, and it is only fetched once for the cluster.
+        primitives.prefetch_base_image(ctx)
+
+        # Request all of the instances before waiting on any of them, so that the
+        # control plane and worker nodes boot at the same time.
+        print(f'Creating {control_plane_count} control plane nodes and '
+              f'{worker_count} worker nodes')
+        new_nodes = primitives.create_instances(
+            ctx, ['control_plane'] * control_plane_count + ['worker'] * worker_count)
+        primitives.await_boot_and_update(ctx, new_nodes)
+
+        # Record the node network address for the first control plane node as the API
+        # address
+        interfaces = client.get_instance_interfaces(md['control_plane_nodes'][0])
+        md['api_address_inner'] = interfaces[0]['ipv4']
+        md['api_address_floating'] = interfaces[0]['floating']
+        primitives.set_cluster_metadata(ctx, md)
+
+        print('Configuring and installing k3s control plane')
+        primitives.install_control_plane(ctx)
+
+        print('Installing workers')
+        primitives.install_workers(ctx)
+
+        # Fetch kubecfg, correct IP, and include cluster name instead of "default"
+        print('Fetching kubecfg for cluster')
+        aop = client.instance_get(
+            md['control_plane_nodes'][0], '/etc/rancher/k3s/k3s.yaml')
+        kubeconfig = primitives.await_fetch(ctx, aop).replace(
+            '127.0.0.1', md['api_address_floating'])
+
+        kc = primitives.yaml_load(kubeconfig)
+        fqcn = '%s.%s' % (name, namespace)
+        kc['clusters'][0]['name'] = fqcn
+        kc['contexts'][0]['name'] = fqcn
+        kc['contexts'][0]['context']['cluster'] = fqcn
+        kc['contexts'][0]['context']['user'] = fqcn
+        kc['users'][0]['name'] = fqcn
+        kc['current-context'] = fqcn
+        kubeconfig = primitives.yaml_dump(kc)
+        md['kubeconfig'] = kubeconfig
+        primitives.set_cluster_metadata(ctx, md)
+
+        # Install metallb and longhorn
+        primitives.setup_metallb(ctx, metal_address_count)
+        primitives.setup_longhorn(ctx)
+
+        # Install the kubeconfig locally
+        primitives.merge_local_kubeconfig(kc)
+
+        md['state'] = 'created'
+        primitives.set_cluster_metadata(ctx, md)
 
 
 k3s.add_command(k3s_create)
@@ -242,7 +207,7 @@ k3s.add_command(k3s_create)
 @click.pass_context
 def k3s_query_k3s_version(ctx, release_channel=None, namespace=None,
                           refresh_version_cache=False):
-    ctx.obj['namespace'] = namespace
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     target_release = primitives.get_k3s_release(
         ctx, force_cache_update=refresh_version_cache,
@@ -261,12 +226,17 @@ k3s.add_command(k3s_query_k3s_version)
                     'version cache is retrieved from.'))
 @click.option('--refresh-version-cache/--no-refresh-version-cache', default=False,
               help=('Force a refresh of the k3s version cache.'))
+@click.option('--force-full/--no-force-full', default=False,
+              help=('Determine the latest version by scanning every release, '
+                    'instead of asking GitHub for its latest release. This '
+                    'implies a refresh of the version cache.'))
 @click.pass_context
-def k3s_query_longhorn_version(ctx, namespace=None, refresh_version_cache=False):
-    ctx.obj['namespace'] = namespace
+def k3s_query_longhorn_version(ctx, namespace=None, refresh_version_cache=False,
+                               force_full=False):
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     target_release = primitives.get_longhorn_release(
-        ctx, force_cache_update=refresh_version_cache)
+        ctx, force_cache_update=refresh_version_cache, full_scan=force_full)
     print(f'Longhorn has {target_release} as its latest version.')
 
 
@@ -281,11 +251,7 @@ k3s.add_command(k3s_query_longhorn_version)
 @click.pass_context
 def k3s_getconfig(ctx, name=None, namespace=None):
     ctx.obj['name'] = name
-    ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(async_strategy=apiclient.ASYNC_CONTINUE)
-
-    if not namespace:
-        namespace = ctx.obj['CLIENT'].namespace
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     md = primitives.get_cluster_metadata(ctx)
     if not md:
@@ -308,8 +274,7 @@ def k3s_getconfig(ctx, name=None, namespace=None):
 @click.pass_context
 def k3s_show(ctx, name=None, namespace=None):
     ctx.obj['name'] = name
-    ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(async_strategy=apiclient.ASYNC_CONTINUE)
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     md = primitives.get_cluster_metadata(ctx)
     if not md:
@@ -329,11 +294,16 @@ k3s.add_command(k3s_show)
 @click.option('--namespace', type=click.STRING,
               help=('If you are an admin, you can alter clusters in a '
                     'different namespace.'))
+@click.option('--safe-teardown/--no-safe-teardown', default=False,
+              help=('Record that the instances are gone before removing the '
+                    'network, so an interrupted delete leaves accurate '
+                    'metadata behind.'))
 @click.pass_context
-def k3s_delete(ctx, name=None, namespace=None):
+def k3s_delete(ctx, name=None, namespace=None, safe_teardown=False):
     ctx.obj['name'] = name
+    client = primitives.get_client(ctx)
+    namespace = namespace or client.namespace
     ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(async_strategy=apiclient.ASYNC_CONTINUE)
 
     # Ensure this name exists
     md = primitives.get_cluster_metadata(ctx)
@@ -346,79 +316,60 @@ def k3s_delete(ctx, name=None, namespace=None):
         _emit_debug(ctx, '    %s = %s' % (k, md[k]))
 
     # Delete instances
-    waiting = []
-    for instance_uuid in set(md['control_plane_nodes'] + md['worker_nodes']):
+    def _delete_instance(instance_uuid):
         try:
-            inst = ctx.obj['CLIENT'].get_instance(instance_uuid)
+            inst = client.get_instance(instance_uuid)
             _emit_debug(ctx, '...Deleting instance %s with uuid %s'
                         % (inst['name'], instance_uuid))
-            ctx.obj['CLIENT'].delete_instance(instance_uuid)
-            waiting.append(instance_uuid)
+            client.delete_instance(instance_uuid)
+            return True
         except apiclient.ResourceNotFoundException:
-            pass
-
-    while waiting:
-        _emit_debug(ctx, '...Waiting for %d instances to be deleted' % len(waiting))
-        for instance_uuid in copy.copy(waiting):
-            try:
-                i = ctx.obj['CLIENT'].get_instance(instance_uuid)
-                if i['state'] == 'deleted':
-                    waiting.remove(instance_uuid)
-            except apiclient.ResourceNotFoundException:
-                waiting.remove(instance_uuid)
-
-        if waiting:
-            time.sleep(1)
-
-    md['control_plane_nodes'] = []
-    md['worker_nodes'] = []
-    md['api_floating_address'] = None
-    md['api_inner_address'] = None
-    md['k3s_version'] = None
-    md['kubeconfig'] = None
-    md['node_token'] = None
-    primitives.set_cluster_metadata(ctx, md)
+            return False
+
+    instance_uuids = list(set(md['control_plane_nodes'] + md['worker_nodes']))
+    deleting = primitives.map_concurrently(_delete_instance, instance_uuids)
+    primitives.await_instances_deleted(
+        ctx, [instance_uuid for instance_uuid, deleted
+              in zip(instance_uuids, deleting) if deleted])
+
+    # The metadata is removed entirely once the network is gone, so this
+    # checkpoint only matters if we fail part way through. A retried delete
+    # copes with instances which have already gone anyway, so it is optional.
+    if safe_teardown:
+        md['control_plane_nodes'] = []
+        md['worker_nodes'] = []
+        md['api_floating_address'] = None
+        md['api_inner_address'] = None
+        md['k3s_version'] = None
+        md['kubeconfig'] = None
+        md['node_token'] = None
+        primitives.set_cluster_metadata(ctx, md)
 
     if md.get('node_network'):
         # Free any routed ips
-        for addr in md.get('routed_addresses', []):
+        def _unroute_address(addr):
             try:
                 _emit_debug(ctx, 'Unrouting address %s from network %s'
                             % (addr, md['node_network']))
-                ctx.obj['CLIENT'].unroute_network_address(
+                client.unroute_network_address(
                     md['node_network'], addr)
             except apiclient.UnauthorizedException:
                 _emit_debug(
                     ctx, '...Address %s was not routed to this network' % addr)
 
-        # Delete node network
-        ctx.obj['CLIENT'].delete_network(md['node_network'])
-        md['node_network'] = []
+        primitives.map_concurrently(
+            _unroute_address, md.get('routed_addresses', []))
 
-    md['state'] = 'deleted'
-    primitives.set_cluster_metadata(ctx, md)
+        # Delete node network
+        client.delete_network(md['node_network'])
 
-    # Then remove the metadata
+    # Then remove the metadata. There is no point recording a final "deleted"
+    # state first, as nothing can observe it before it is removed.
     primitives.delete_cluster_metadata(ctx)
-    namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-    all_clusters = namespace_md.get(CLUSTER_LIST, [])
-    all_clusters.remove(name)
-    if not all_clusters:
-        ctx.obj['CLIENT'].delete_namespace_metadata_item(namespace, CLUSTER_LIST)
-    else:
-        ctx.obj['CLIENT'].set_namespace_metadata_item(
-            namespace, CLUSTER_LIST, all_clusters)
+    primitives.remove_cluster_from_namespace(ctx, namespace, name)
 
     # And remove the local config
-    fqcn = '%s.%s' % (name, namespace)
-    for config_elem in ['users.%s' % fqcn,
-                        'contexts.%s' % fqcn,
-                        'clusters.%s' % fqcn]:
-        p = subprocess.run(
-            'kubectl config unset %s' % config_elem, shell=True)
-        if p.returncode != 0:
-            print('Could not unset kubectl config element %s' % config_elem)
-            sys.exit(1)
+    primitives.remove_local_kubeconfig('%s.%s' % (name, namespace))
 
 
 k3s.add_command(k3s_delete)
@@ -434,9 +385,7 @@ k3s.add_command(k3s_delete)
 @click.pass_context
 def k3s_expand_workers(ctx, name=None, worker_count=None, namespace=None):
     ctx.obj['name'] = name
-    ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(
-        async_strategy=apiclient.ASYNC_CONTINUE)
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     md = primitives.get_cluster_metadata(ctx)
     if not md:
@@ -460,9 +409,7 @@ k3s.add_command(k3s_expand_workers)
 @click.pass_context
 def k3s_expand_addresses(ctx, name=None, address_count=None, namespace=None):
     ctx.obj['name'] = name
-    ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(
-        async_strategy=apiclient.ASYNC_CONTINUE)
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     md = primitives.get_cluster_metadata(ctx)
     if not md:
@@ -484,9 +431,7 @@ k3s.add_command(k3s_expand_addresses)
 @click.pass_context
 def k3s_update_os(ctx, name=None, namespace=None):
     ctx.obj['name'] = name
-    ctx.obj['namespace'] = namespace
-    ctx.obj['CLIENT'] = apiclient.Client(
-        async_strategy=apiclient.ASYNC_CONTINUE)
+    ctx.obj['namespace'] = namespace or primitives.get_client(ctx).namespace
 
     md = primitives.get_cluster_metadata(ctx)
     if not md:
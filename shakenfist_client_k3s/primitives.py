@@ -1,21 +1,235 @@
+import base64
+import concurrent.futures
+import contextlib
 import copy
 import json
+import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
 from shakenfist_client import apiclient
+import shlex
 import sys
+import tempfile
 import time
+import urllib.parse
+from urllib3.util.retry import Retry
 from versions import parse_version
+import yaml
 
 
+CLUSTER_LIST = 'orchestrated_k3s_clusters'
 METADATA_KEY = 'orchestrated_k3s_cluster_%s'
 K3S_VERSION_CACHE_KEY = 'orchestrated_k3s_cluster_k3s_version_cache'
 LONGHORN_VERSION_CACHE_KEY = 'orchestrated_k3s_cluster_longhorn_version_cache'
 BASE_OS_VERSION = 'debian:12'
+LONGHORN_RELEASES_URL = 'https://api.github.com/repos/longhorn/longhorn/releases'
+
+# Every node has the same network interface and disk, apart from which network
+# the interface is on. Callers must copy these before changing them.
+NODE_NETWORK_TEMPLATE = {
+    'network_uuid': None,
+    'macaddress': None,
+    'model': 'virtio',
+    'float': True
+}
+NODE_DISK_TEMPLATE = {
+    'size': 50,
+    'base': BASE_OS_VERSION,
+    'bus': None,
+    'type': 'disk'
+}
+
+# The metallb address pool and its advertisement. Only the pool's addresses
+# change between clusters, and they are filled in on a copy of the template.
+METALLB_POOL_TEMPLATE = {
+    'apiVersion': 'metallb.io/v1beta1',
+    'kind': 'IPAddressPool',
+    'metadata': {
+        'name': 'empty',
+        'namespace': 'metallb-system'
+    },
+    'spec': None
+}
+METALLB_ADVERTISEMENT = {
+    'apiVersion': 'metallb.io/v1beta1',
+    'kind': 'L2Advertisement',
+    'metadata': {
+        'name': 'empty',
+        'namespace': 'metallb-system'
+    }
+}
+
+# The most pages of releases we will fetch when scanning a project's releases
+MAX_RELEASE_PAGES = 10
+
+# The most API requests we will have in flight at once when fanning out
+# requests which don't depend on each other.
+MAX_PARALLEL_REQUESTS = 10
+
+# These are run as a single script with as_script(). dist-upgrade must not stop
+# to ask about changed configuration files, there is nobody there to answer.
+OS_UPDATE_COMMANDS = [
+    'export DEBIAN_FRONTEND=noninteractive',
+    'apt-get update -qq',
+    'apt-get -o Dpkg::Options::=--force-confold -yq dist-upgrade'
+]
+
+# Use the libyaml C bindings when PyYAML was built with them, they are much
+# faster than the pure python implementation.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+# A single session is used for requests to services other than Shaken Fist,
+# so that connections are reused between them. It is created on first use by
+# _get_session(), as most commands never need it.
+_SESSION = None
+
+
+class ClusterExistsException(Exception):
+    ...
+
+
+def _get_session():
+    global _SESSION
+
+    if not _SESSION:
+        # Transient server errors are retried. If they persist the last
+        # response is returned rather than raised, so that callers can report
+        # the status code like any other failure.
+        session = requests.Session()
+        session.headers['User-Agent'] = apiclient.get_user_agent()
+        session.mount(
+            'https://',
+            HTTPAdapter(
+                pool_connections=16, pool_maxsize=32,
+                max_retries=Retry(
+                    total=3, backoff_factor=0.3,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False)))
+        _SESSION = session
+    return _SESSION
 
 
 def _emit_debug(ctx, m):
+    # m may be a callable, so that expensive messages are only built when
+    # they will actually be printed.
     if ctx.obj['VERBOSE']:
-        print(m)
+        print(m() if callable(m) else m)
+
+
+def yaml_load(data):
+    return yaml.load(data, Loader=YAML_LOADER)
+
+
+def yaml_dump(data):
+    return yaml.dump(data, Dumper=YAML_DUMPER)
+
+
+def yaml_dump_all(documents):
+    return yaml.dump_all(documents, Dumper=YAML_DUMPER)
+
+
+def backoff(initial=0.25, cap=5.0, factor=1.5):
+    # Yield increasing delays between polls, so that fast transitions are
+    # noticed quickly but slow ones don't hammer the API. A little jitter
+    # stops concurrent waiters from polling in lockstep.
+    delay = initial
+    while True:
+        yield delay
+        delay = min(cap, delay * factor + random.uniform(0, 0.1))
+
+
+def poll_until(fetch, done, result=None, initial=0.25, cap=5.0):
+    # Call fetch() until done() is true for what it returns. Callers which
+    # already hold a result can pass it in to skip the first fetch.
+    if result is None:
+        result = fetch()
+
+    delays = backoff(initial=initial, cap=cap)
+    while not done(result):
+        time.sleep(next(delays))
+        result = fetch()
+    return result
+
+
+def get_client(ctx):
+    # Reuse the client shakenfist_client's CLI has already constructed where
+    # there is one, as constructing a client costs round trips to the API to
+    # authenticate and collect capabilities. We always wait for operations
+    # ourselves, so the client should never block on them.
+    client = ctx.obj.get('CLIENT')
+    if not client:
+        client = apiclient.Client(async_strategy=apiclient.ASYNC_CONTINUE)
+        ctx.obj['CLIENT'] = client
+    client.async_strategy = apiclient.ASYNC_CONTINUE
+    return client
+
+
+# Namespace metadata is cached for the life of a single CLI invocation. We
+# are the only writer we care about during that time, so our own writes are
+# applied to the cache instead of invalidating it, and writes which wouldn't
+# change anything are skipped. Callers get their own copy of the metadata, so
+# that changing it doesn't silently change the cache.
+def _cached_namespace_metadata(ctx, namespace):
+    cache = ctx.obj.setdefault('NAMESPACE_METADATA', {})
+    if namespace not in cache:
+        cache[namespace] = get_client(ctx).get_namespace_metadata(namespace)
+    return cache[namespace]
+
+
+def get_namespace_metadata_item(ctx, namespace, key, default=None):
+    # Only copy the one item, not everything else stored in the namespace
+    return copy.deepcopy(
+        _cached_namespace_metadata(ctx, namespace).get(key, default))
+
+
+def set_namespace_metadata_item(ctx, namespace, key, value):
+    cached = ctx.obj.get('NAMESPACE_METADATA', {}).get(namespace)
+    if cached is not None and key in cached and cached[key] == value:
+        _emit_debug(ctx, f'Metadata {key} is unchanged, not writing it')
+        return
+
+    get_client(ctx).set_namespace_metadata_item(namespace, key, value)
+    if cached is not None:
+        cached[key] = copy.deepcopy(value)
+
+
+def delete_namespace_metadata_item(ctx, namespace, key):
+    get_client(ctx).delete_namespace_metadata_item(namespace, key)
+    cached = ctx.obj.get('NAMESPACE_METADATA', {}).get(namespace)
+    if cached is not None:
+        cached.pop(key, None)
+
+
+def add_cluster_to_namespace(ctx, namespace, name):
+    # Namespace metadata has no compare-and-set operation, so this is still a
+    # read-modify-write. The cached copy may be from well before now, so it is
+    # dropped and both the cluster list and the cluster's own metadata are
+    # checked from a fresh read taken immediately before the write. This keeps
+    # the window for a racing create small.
+    ctx.obj.get('NAMESPACE_METADATA', {}).pop(namespace, None)
+    all_clusters = get_namespace_metadata_item(
+        ctx, namespace, CLUSTER_LIST, [])
+    if (name in all_clusters or
+            get_namespace_metadata_item(ctx, namespace, METADATA_KEY % name)):
+        raise ClusterExistsException(
+            'Cluster %s already exists in namespace %s' % (name, namespace))
+
+    set_namespace_metadata_item(
+        ctx, namespace, CLUSTER_LIST, all_clusters + [name])
+
+
+def remove_cluster_from_namespace(ctx, namespace, name):
+    all_clusters = [
+        cluster
+        for cluster in get_namespace_metadata_item(ctx, namespace, CLUSTER_LIST, [])
+        if cluster != name]
+    if not all_clusters:
+        delete_namespace_metadata_item(ctx, namespace, CLUSTER_LIST)
+    else:
+        set_namespace_metadata_item(ctx, namespace, CLUSTER_LIST, all_clusters)
 
 
 def get_cluster_metadata(ctx):
@@ -24,8 +238,7 @@ def get_cluster_metadata(ctx):
 
     md_key = METADATA_KEY % name
     if md_key not in ctx.obj:
-        namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-        ctx.obj[md_key] = namespace_md.get(md_key)
+        ctx.obj[md_key] = get_namespace_metadata_item(ctx, namespace, md_key)
     return ctx.obj[md_key]
 
 
@@ -35,7 +248,45 @@ def set_cluster_metadata(ctx, md):
 
     md_key = METADATA_KEY % name
     ctx.obj[md_key] = md
-    ctx.obj['CLIENT'].set_namespace_metadata_item(namespace, md_key, md)
+    if ctx.obj.get('DEFER_CLUSTER_METADATA'):
+        ctx.obj['CLUSTER_METADATA_DIRTY'] = True
+        return
+    set_namespace_metadata_item(ctx, namespace, md_key, md)
+
+
+def flush_cluster_metadata(ctx):
+    # Write out cluster metadata held back by defer_cluster_metadata. This is
+    # used as a checkpoint after we have allocated resources which would be
+    # leaked if we crashed without recording them.
+    if not ctx.obj.pop('CLUSTER_METADATA_DIRTY', False):
+        return
+
+    md_key = METADATA_KEY % ctx.obj['name']
+    set_namespace_metadata_item(
+        ctx, ctx.obj['namespace'], md_key, ctx.obj[md_key])
+
+
+@contextlib.contextmanager
+def defer_cluster_metadata(ctx):
+    # Buffer cluster metadata updates in memory and write them out once at the
+    # end, or when flush_cluster_metadata is called, instead of on every
+    # set_cluster_metadata. The buffer is flushed on failure too, so that we
+    # don't forget about resources we created before the failure.
+    ctx.obj['DEFER_CLUSTER_METADATA'] = True
+    try:
+        yield
+    except BaseException:
+        # The original failure is what the user needs to see, so a failure to
+        # flush here is reported but doesn't replace it.
+        ctx.obj['DEFER_CLUSTER_METADATA'] = False
+        try:
+            flush_cluster_metadata(ctx)
+        except Exception as e:
+            print(f'Failed to save cluster metadata: {e}')
+        raise
+
+    ctx.obj['DEFER_CLUSTER_METADATA'] = False
+    flush_cluster_metadata(ctx)
 
 
 def delete_cluster_metadata(ctx):
@@ -44,7 +295,18 @@ def delete_cluster_metadata(ctx):
 
     md_key = METADATA_KEY % name
     del ctx.obj[md_key]
-    ctx.obj['CLIENT'].delete_namespace_metadata_item(namespace, md_key)
+    delete_namespace_metadata_item(ctx, namespace, md_key)
+
+
+def _k3s_cache_ttl(release_channel):
+    # How long cached release data is trusted for. The latest channel moves
+    # often, whereas a channel pinned to a minor version like v1.26 only moves
+    # for patch releases.
+    if release_channel == 'latest':
+        return 6 * 3600
+    if release_channel and release_channel.startswith('v'):
+        return 7 * 24 * 3600
+    return 24 * 3600
 
 
 def get_k3s_release(ctx, force_cache_update=False, release_channel=None):
@@ -54,149 +316,244 @@ def get_k3s_release(ctx, force_cache_update=False, release_channel=None):
         version_cache = {'updated': 0}
         _emit_debug(ctx, 'Forcing cache update')
     else:
-        namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-        version_cache = namespace_md.get(
-            K3S_VERSION_CACHE_KEY, {'updated': 0, 'releases': {}})
+        version_cache = get_namespace_metadata_item(
+            ctx, namespace, K3S_VERSION_CACHE_KEY,
+            {'updated': 0, 'releases': {}})
         if not isinstance(version_cache, dict):
             _emit_debug(ctx, 'Version cache format invalid, clobbering')
             version_cache = {'updated': 0}
 
     updated = version_cache.get('updated', 0)
 
-    _emit_debug(ctx, (f'Cached version information from {updated}: '
-                      f'{version_cache.get('releases', {})}'))
+    _emit_debug(ctx, lambda: (f'Cached version information from {updated}: '
+                              f'{version_cache.get('releases', {})}'))
 
-    if time.time() - updated > 24 * 3600:
-        _emit_debug(ctx, 'Updating release version cache')
+    refreshed = False
+    if time.time() - updated > _k3s_cache_ttl(release_channel):
+        _refresh_k3s_releases(ctx, namespace, version_cache)
+        refreshed = True
+
+    # Channels are cached together, so a channel which was added since the
+    # cache was last refreshed would otherwise be missing until it expires.
+    if release_channel not in version_cache.get('releases', {}) and not refreshed:
+        _emit_debug(ctx, f'Release channel {release_channel} not cached')
+        _refresh_k3s_releases(ctx, namespace, version_cache)
+
+    most_recent = version_cache['releases'].get(release_channel, None)
+    if not most_recent:
+        print(f'Release channel {release_channel} not found')
+        sys.exit(1)
+
+    _emit_debug(ctx, f'Selected kubernetes version: {most_recent}')
+    return most_recent
 
-        url = 'https://update.k3s.io/v1-release/channels'
-        _emit_debug(ctx, f'Fetching {url}')
-        r = requests.request(
-            'GET', url,
+
+def _refresh_k3s_releases(ctx, namespace, version_cache):
+    _emit_debug(ctx, 'Updating release version cache')
+
+    # Revalidate what we have rather than fetching it again, if the server
+    # told us how to last time.
+    url = 'https://update.k3s.io/v1-release/channels'
+    _emit_debug(ctx, f'Fetching {url}')
+    try:
+        r = _get_session().get(
+            url,
             headers={
                 'Accept': 'application/json',
-                'User-Agent': apiclient.get_user_agent()
-            })
-        if r.status_code not in [200, 201, 204]:
-            print('Unable to determine latest k3s release version')
-            print('    GET {url}')
-            print(f'    returned HTTP status code {r.status_code} with text:')
-            print(f'    {r.text}')
-            sys.exit(1)
+                **_revalidation_headers(version_cache)
+            },
+            timeout=10)
+    except requests.exceptions.RequestException as e:
+        print('Unable to determine latest k3s release version')
+        print(f'    GET {url}')
+        print(f'    failed with: {e}')
+        sys.exit(1)
 
+    if r.status_code == 304:
+        _emit_debug(ctx, 'Release data unchanged')
+    elif r.status_code not in [200, 201, 204]:
+        print('Unable to determine latest k3s release version')
+        print(f'    GET {url}')
+        print(f'    returned HTTP status code {r.status_code} with text:')
+        print(f'    {r.text}')
+        sys.exit(1)
+    else:
         d = r.json()
         releases = {}
         _emit_debug(ctx, 'Fetched release data:')
-        _emit_debug(ctx, json.dumps(d, indent=4, sort_keys=True))
+        _emit_debug(ctx, lambda: json.dumps(d, indent=4, sort_keys=True))
         for reldata in d['data']:
             releases[reldata['name']] = reldata['latest']
 
         version_cache['releases'] = releases
-        version_cache['updated'] = time.time()
-        ctx.obj['CLIENT'].set_namespace_metadata_item(
-            namespace, K3S_VERSION_CACHE_KEY, version_cache)
+        _record_validators(version_cache, r)
 
-    most_recent = version_cache['releases'].get(release_channel, None)
-    if not most_recent:
-        print(f'Release channel {release_channel} not found')
+    version_cache['updated'] = time.time()
+    set_namespace_metadata_item(
+        ctx, namespace, K3S_VERSION_CACHE_KEY, version_cache)
+
+
+def _revalidation_headers(version_cache):
+    # Headers which let the server tell us that our cached copy is still
+    # current with a 304, rather than sending it all again.
+    headers = {}
+    if version_cache.get('releases'):
+        if version_cache.get('etag'):
+            headers['If-None-Match'] = version_cache['etag']
+        if version_cache.get('last_modified'):
+            headers['If-Modified-Since'] = version_cache['last_modified']
+    return headers
+
+
+def _record_validators(version_cache, r):
+    version_cache['etag'] = r.headers.get('ETag')
+    version_cache['last_modified'] = r.headers.get('Last-Modified')
+
+
+def _fetch_github(ctx, url, headers=None):
+    _emit_debug(ctx, f'Fetching {url}')
+    try:
+        return _get_session().get(
+            url,
+            headers={
+                'Accept': 'application/vnd.github+json',
+                **(headers or {})
+            },
+            timeout=10)
+    except requests.exceptions.RequestException as e:
+        print(
+            'Unable to determine latest longhorn release version\n'
+            f'    GET {url}\n'
+            f'    failed with: {e}')
         sys.exit(1)
 
-    _emit_debug(ctx, f'Selected kubernetes version: {most_recent}')
-    return most_recent
 
+def _github_json(ctx, url, r):
+    if r.status_code not in [200, 201, 204]:
+        print(
+            'Unable to determine latest longhorn release version\n'
+            f'    GET {url}\n'
+            f'    returned HTTP status code {r.status_code} '
+            'with text:\n'
+            f'    {r.text}')
+        sys.exit(1)
 
-def get_longhorn_release(ctx, force_cache_update=False):
+    d = r.json()
+    _emit_debug(ctx, 'Fetched release data:')
+    _emit_debug(ctx, lambda: json.dumps(d, indent=4, sort_keys=True))
+    return d
+
+
+def _fetch_all_longhorn_releases(ctx):
+    def _fetch_page(page):
+        url = f'{LONGHORN_RELEASES_URL}?per_page=100&page={page}'
+        return url, _fetch_github(ctx, url)
+
+    # The Link header on the first page tells us how many pages there are. The
+    # rest don't depend on each other, so they are then fetched all at once.
+    url, r = _fetch_page(1)
+    pages = [_github_json(ctx, url, r)]
+    last_url = r.links.get('last', {}).get('url')
+    if last_url:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(last_url).query)
+        last_page = min(int(query['page'][0]), MAX_RELEASE_PAGES)
+        for url, r in map_concurrently(_fetch_page, range(2, last_page + 1)):
+            pages.append(_github_json(ctx, url, r))
+
+    releases = {}
+    for page in pages:
+        for reldata in page:
+            if reldata['prerelease']:
+                continue
+            tagname = reldata['tag_name'].lstrip('v')
+            releases[tagname] = reldata['tarball_url']
+
+    # Find the most recent version
+    latest = max(releases, key=parse_version)
+    return releases, parse_version(latest).to_string()
+
+
+def get_longhorn_release(ctx, force_cache_update=False, full_scan=False):
     namespace = ctx.obj['namespace']
 
-    if force_cache_update:
+    if force_cache_update or full_scan:
         version_cache = {'updated': 0}
         _emit_debug(ctx, 'Forcing cache update')
     else:
-        namespace_md = ctx.obj['CLIENT'].get_namespace_metadata(namespace)
-        version_cache = namespace_md.get(
-            LONGHORN_VERSION_CACHE_KEY, {'updated': 0, 'releases': {}})
+        version_cache = get_namespace_metadata_item(
+            ctx, namespace, LONGHORN_VERSION_CACHE_KEY,
+            {'updated': 0, 'releases': {}})
         if not isinstance(version_cache, dict):
             _emit_debug(ctx, 'Version cache format invalid, clobbering')
             version_cache = {'updated': 0}
 
     updated = version_cache.get('updated', 0)
 
-    _emit_debug(ctx, (f'Cached version information from {updated}: '
-                      f'{version_cache.get('releases', {})}'))
+    _emit_debug(ctx, lambda: (f'Cached version information from {updated}: '
+                              f'{version_cache.get('releases', {})}'))
 
     if time.time() - updated > 24 * 3600:
         _emit_debug(ctx, 'Updating release version cache')
 
-        releases = {}
-        for page in range(5):
-            url = f'https://api.github.com/repos/longhorn/longhorn/releases?page={
-                page}'
-            _emit_debug(ctx, f'Fetching {url}')
-            r = requests.request(
-                'GET', url,
-                headers={
-                    'Accept': 'application/vnd.github+json',
-                    'User-Agent': apiclient.get_user_agent()
-                })
-
-            if r.status_code not in [200, 201, 204]:
-                print(
-                    'Unable to determine latest k3s release version\n'
-                    f'    GET {url}\n'
-                    f'    returned HTTP status code {r.status_code} '
-                    'with text:\n'
-                    f'    {r.text}')
-                sys.exit(1)
-
-            d = r.json()
-            _emit_debug(ctx, 'Fetched release data:')
-            _emit_debug(ctx, json.dumps(d, indent=4, sort_keys=True))
-            for reldata in d:
-                if reldata['prerelease']:
-                    continue
-                tagname = reldata['tag_name'].lstrip('v')
-                releases[tagname] = reldata['tarball_url']
-
-        # Find the most recent version
-        latest = None
-        for tagname in list(releases.keys()):
-            parsed_version = parse_version(tagname)
-            if not latest:
-                latest = parsed_version
-            elif parsed_version > latest:
-                latest = parsed_version
+        if full_scan:
+            # Work out the latest version for ourselves from the release list
+            releases, latest = _fetch_all_longhorn_releases(ctx)
+            version_cache['releases'] = releases
+            version_cache['latest'] = latest
+        else:
+            # GitHub can tell us which release is the latest directly, which
+            # costs one request instead of a page per hundred releases
+            url = f'{LONGHORN_RELEASES_URL}/latest'
+            r = _fetch_github(
+                ctx, url, headers=_revalidation_headers(version_cache))
+            if r.status_code == 304:
+                _emit_debug(ctx, 'Release data unchanged')
+            else:
+                d = _github_json(ctx, url, r)
+                latest = d['tag_name'].lstrip('v')
+                version_cache['releases'] = {latest: d['tarball_url']}
+                version_cache['latest'] = latest
+                _record_validators(version_cache, r)
 
-        version_cache['releases'] = releases
-        version_cache['latest'] = latest.to_string()
         version_cache['updated'] = time.time()
-        ctx.obj['CLIENT'].set_namespace_metadata_item(
-            namespace, LONGHORN_VERSION_CACHE_KEY, version_cache)
+        set_namespace_metadata_item(
+            ctx, namespace, LONGHORN_VERSION_CACHE_KEY, version_cache)
 
     return version_cache['latest']
 
 
-def create_instance(ctx):
+def prefetch_base_image(ctx):
+    # Ask Shaken Fist to cache the base image once before any instances are
+    # created, instead of the download hiding inside the first instance boot.
+    # This is only an optimisation, so failures are reported and ignored as
+    # instance creation will fetch the image anyway.
+    client = get_client(ctx)
+    print(f'Caching base image {BASE_OS_VERSION}')
+    try:
+        artifact = client.cache_artifact(
+            BASE_OS_VERSION, namespace=ctx.obj['namespace'])
+        artifact = poll_until(
+            lambda: client.get_artifact(artifact['uuid']),
+            lambda a: a['state'] != 'initial', result=artifact)
+    except apiclient.APIException as e:
+        print(f'...unable to cache base image, continuing anyway: {e}')
+        return
+
+    if artifact['state'] != 'created':
+        print(f'...base image artifact has state {artifact['state']}, '
+              'continuing anyway')
+        return
+    print('...Base image cached')
+
+
+def create_instance(ctx, node_serial):
     md = get_cluster_metadata(ctx)
 
-    node_name = 'k3s-%s-node-%03d' % (md['name'], md['node_serial'])
-    inst = ctx.obj['CLIENT'].create_instance(
+    node_name = 'k3s-%s-node-%03d' % (md['name'], node_serial)
+    inst = get_client(ctx).create_instance(
         node_name, 2, 2048,
-        [
-            {
-                'network_uuid': md['node_network'],
-                'macaddress': None,
-                'model': 'virtio',
-                'float': True
-            }
-        ],
-        [
-            {
-                'size': 50,
-                'base': BASE_OS_VERSION,
-                'bus': None,
-                'type': 'disk'
-            }
-        ],
+        [dict(NODE_NETWORK_TEMPLATE, network_uuid=md['node_network'])],
+        [dict(NODE_DISK_TEMPLATE)],
         md.get('ssh_key'), None,
         side_channels=['sf-agent'],
         namespace=md['namespace']
@@ -204,53 +561,174 @@ def create_instance(ctx):
     return inst
 
 
-def await_boot(ctx, instances):
-    waiting = copy.copy(instances)
-    while waiting:
+def list_instances(ctx, instance_uuids):
+    # Fetch the current state of a set of instances concurrently, keyed by
+    # UUID. Instances which no longer exist are left out. The instance listing
+    # isn't used for this: without all=True it hides instances in error or
+    # deleted, and with it every poll would fetch the whole history of the
+    # namespace.
+    client = get_client(ctx)
+
+    def _get(instance_uuid):
+        try:
+            return client.get_instance(instance_uuid)
+        except apiclient.ResourceNotFoundException:
+            return None
+
+    instance_uuids = list(instance_uuids)
+    return {
+        instance_uuid: inst
+        for instance_uuid, inst in zip(
+            instance_uuids, map_concurrently(_get, instance_uuids))
+        if inst}
+
+
+def await_instances_deleted(ctx, instances):
+    # The API has no way to notify us of state changes, so the best we can do
+    # is poll the instances we are waiting on. Instances which are deleted or
+    # no longer exist are gone.
+    waiting = set(instances)
+    if not waiting:
+        return
+
+    def _still_deleting():
+        remaining = set()
+        for instance_uuid, inst in list_instances(ctx, waiting).items():
+            if inst['state'] != 'deleted':
+                remaining.add(instance_uuid)
+        if remaining:
+            _emit_debug(ctx, '...Waiting for %d instances to be deleted'
+                        % len(remaining))
+        return remaining
+
+    poll_until(_still_deleting, lambda remaining: not remaining)
+
+
+def map_concurrently(fn, items):
+    # Call fn for each item concurrently, returning the results in the same
+    # order as the items. This is for independent API requests, where the time
+    # taken is almost entirely spent waiting on the network.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        return list(executor.map(fn, items))
+
+
+def _poll_instances(instance_uuids, fetch):
+    # Call fetch for each instance concurrently, so that a poll of a whole
+    # cluster costs about one round trip to the API instead of one per node.
+    instance_uuids = list(instance_uuids)
+    return dict(zip(instance_uuids, map_concurrently(fetch, instance_uuids)))
+
+
+def await_boot(ctx, instances, on_ready=None):
+    # on_ready, if given, is called with the instances which have become ready
+    # on each poll, so that callers can start work on them while the rest are
+    # still booting.
+    waiting = set(instances)
+    if not waiting:
+        return
+
+    delays = backoff()
+    while True:
         print('Waiting for %d instances to boot' % len(waiting))
-        for instance_uuid in copy.copy(waiting):
-            inst = ctx.obj['CLIENT'].get_instance(instance_uuid)
+        polled = list_instances(ctx, waiting)
+        ready = []
+        for instance_uuid, inst in polled.items():
             print('...instance %s has state %s and agent state %s'
                   % (inst['name'], inst['state'], inst['agent_state']))
             if inst['state'] == 'created' and inst['agent_state'] == 'ready':
-                waiting.remove(instance_uuid)
+                ready.append(instance_uuid)
+
+        # Instances which have failed or gone away are never going to boot, so
+        # there is no point waiting for them.
+        failed = [
+            instance_uuid for instance_uuid in waiting
+            if instance_uuid not in polled
+            or polled[instance_uuid]['state'] in ['error', 'deleted']]
+        if failed:
+            print('Instances failed to boot: %s' % ', '.join(sorted(failed)))
+            sys.exit(1)
 
+        waiting -= set(ready)
+        if ready and on_ready:
+            on_ready(ready)
+
+        # If everything was already ready on this poll there is no point
+        # sleeping before we return.
         if not waiting:
             break
-        time.sleep(5)
 
-    instance_os_update(ctx, instances)
+        # Instances tend to become ready together, so once one has we go
+        # back to polling quickly for the rest.
+        if ready:
+            delays = backoff()
+        time.sleep(next(delays))
+
+
+def await_boot_and_update(ctx, instances):
+    # Start the OS update on each instance as soon as it has booted, instead
+    # of waiting for every instance to boot first.
+    aops = []
+    await_boot(
+        ctx, instances,
+        on_ready=lambda ready: aops.extend(
+            submit_commands(ctx, ready, [as_script(OS_UPDATE_COMMANDS)])))
+    await_and_reap(ctx, instances, aops)
 
 
 def await_idle(ctx, instances):
-    waiting = copy.copy(instances)
+    client = get_client(ctx)
+
+    # Instance names are only needed for progress messages and don't change,
+    # so they are looked up once. There is no bulk query for agent operations,
+    # so those are still fetched per instance, but concurrently.
+    names = {
+        instance_uuid: inst['name']
+        for instance_uuid, inst in list_instances(ctx, instances).items()}
+
+    # all=True is required here. Without it the API only returns operations
+    # which the agent hasn't picked up yet, and an operation which is still
+    # running would not be waited for.
+    def _fetch(instance_uuid):
+        return client.get_instance_agentoperations(instance_uuid, all=True)
+
+    waiting = set(instances)
+    delays = backoff()
     while waiting:
         print('Waiting for %d instances to be idle' % len(waiting))
-        for instance_uuid in copy.copy(waiting):
-            inst = ctx.obj['CLIENT'].get_instance(instance_uuid)
-            agent_ops = ctx.obj['CLIENT'].get_instance_agentoperations(
-                instance_uuid, all=True)
-
+        polled = _poll_instances(waiting, _fetch)
+        for instance_uuid, agent_ops in polled.items():
             incomplete = 0
             for aop in agent_ops:
                 if aop['state'] != 'complete':
                     incomplete += 1
             print('...instance %s has %d incomplete agent operations'
-                  % (inst['name'], incomplete))
+                  % (names.get(instance_uuid, instance_uuid), incomplete))
 
             if incomplete == 0:
-                waiting.remove(instance_uuid)
+                waiting.discard(instance_uuid)
 
         if not waiting:
             break
-        time.sleep(5)
+        if len(waiting) < len(polled):
+            delays = backoff()
+        time.sleep(next(delays))
 
 
 def await_fetch(ctx, aop):
-    while aop['state'] not in ['complete', 'error']:
+    client = get_client(ctx)
+
+    def _finished(aop):
+        if aop['state'] in ['complete', 'error']:
+            return True
         print(f'...fetch operation has state {aop['state']}')
-        time.sleep(1)
-        aop = ctx.obj['CLIENT'].get_agent_operation(aop['uuid'])
+        return False
+
+    # Fetches are almost always of small files and finish quickly, so they are
+    # polled more eagerly than other operations.
+    aop = poll_until(
+        lambda: client.get_agent_operation(aop['uuid']),
+        _finished, result=aop, initial=0.1, cap=2.0)
 
     if aop['state'] == 'error':
         print('File fetch failed:')
@@ -259,74 +737,121 @@ def await_fetch(ctx, aop):
         sys.exit(1)
 
     blob_uuid = aop['results']['0']['content_blob']
-    data = b''
-    for chunk in ctx.obj['CLIENT'].get_blob_data(blob_uuid):
-        data += chunk
-    return data.decode('utf-8')
+    return b''.join(client.get_blob_data(blob_uuid)).decode('utf-8')
 
 
 def reap_execute(ctx, aop):
-    while aop['state'] != 'complete':
-        time.sleep(1)
-        aop = ctx.obj['CLIENT'].get_agent_operation(aop['uuid'])
+    client = get_client(ctx)
+    aop = poll_until(
+        lambda: client.get_agent_operation(aop['uuid']),
+        lambda aop: aop['state'] == 'complete', result=aop)
 
     if aop['results']['0']['return-code'] != 0:
-        inst = ctx.obj['CLIENT'].get_instance(aop['instance_uuid'])
+        inst = client.get_instance(aop['instance_uuid'])
 
         print('Command failed!')
         print('  instance: %s (UUID %s)'
               % (inst['name'], aop['instance_uuid']))
         print('  command: %s' % aop['commands'][0]['commandline'])
         print('exit code: %s' % aop['results']['0']['return-code'])
-        print('   stdout: %s' % '\n   stdout: '.join(
-            aop['results']['0']['stdout'].split('\n')))
-        print('   stderr: %s' % '\n   stderr'.join(
-            aop['results']['0']['stderr'].split('\n')))
+        print('   stdout: %s' % aop['results']['0']['stdout'].replace(
+            '\n', '\n   stdout: '))
+        print('   stderr: %s' % aop['results']['0']['stderr'].replace(
+            '\n', '\n   stderr: '))
         sys.exit(1)
 
 
-def create_and_await_instances(ctx, count, node_type):
+def create_instances(ctx, node_types):
     md = get_cluster_metadata(ctx)
 
+    # Each instance creation is an independent request to the API, so they are
+    # all made at once. Serials are handed out before any request is made so
+    # that node names don't depend on the order in which requests complete.
+    first_serial = md['node_serial']
+    md['node_serial'] += len(node_types)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        futures = [
+            executor.submit(create_instance, ctx, first_serial + i)
+            for i in range(len(node_types))]
+
+    # Record every instance which was created before reporting any failure, so
+    # that a partial failure doesn't leave instances we don't know about.
     new_nodes = []
-    for i in range(count):
-        inst = create_instance(ctx)
+    failure = None
+    for node_type, future in zip(node_types, futures):
+        try:
+            inst = future.result()
+        except Exception as e:
+            failure = failure or e
+            continue
+
         new_nodes.append(inst['uuid'])
-        md['node_serial'] += 1
         md[f'{node_type}_nodes'].append(inst['uuid'])
-        set_cluster_metadata(ctx, md)
         print(f'Created {inst['name']} as a {node_type} node '
               f'(uuid {inst['uuid']})')
 
-    await_boot(ctx, new_nodes)
     set_cluster_metadata(ctx, md)
+    flush_cluster_metadata(ctx)
+    if failure:
+        raise failure
+    return new_nodes
 
 
-def execute_and_await(ctx, instance_uuids, cmds):
+def create_and_await_instances(ctx, count, node_type):
+    # create_instances() has already recorded the new nodes, and booting them
+    # doesn't change the cluster metadata, so there is nothing to write after.
+    new_nodes = create_instances(ctx, [node_type] * count)
+    await_boot_and_update(ctx, new_nodes)
+
+
+def submit_commands(ctx, instance_uuids, cmds):
+    # Queue the commands on every instance without waiting for them to run.
+    # The agent on an instance runs its commands in the order they were
+    # queued, so each instance has its commands submitted in order by a
+    # single worker, while the instances are handled concurrently.
+    client = get_client(ctx)
+
+    def _submit(instance_uuid):
+        return [client.instance_execute(instance_uuid, cmd) for cmd in cmds]
+
     aops = []
-    for cmd in cmds:
-        for instance_uuid in instance_uuids:
-            aops.append(ctx.obj['CLIENT'].instance_execute(
-                instance_uuid, cmd))
+    for instance_aops in map_concurrently(_submit, instance_uuids):
+        aops.extend(instance_aops)
+    return aops
 
-    # Wait for instances to be idle and check results
+
+def await_and_reap(ctx, instance_uuids, aops):
+    # Wait for instances to be idle and check results. Once the instances are
+    # idle the operations should all be complete, so their final states are
+    # fetched all at once and then checked in order.
     await_idle(ctx, instance_uuids)
-    for aop in aops:
+    client = get_client(ctx)
+    for aop in map_concurrently(
+            lambda aop: client.get_agent_operation(aop['uuid']), aops):
         reap_execute(ctx, aop)
 
 
+def as_script(cmds):
+    # Combine commands into a single command which runs them in order, and
+    # stops at the first failure. This costs one agent operation instead of
+    # one per command.
+    return 'bash -c %s' % shlex.quote(
+        'set -euo pipefail\n' + '\n'.join(cmds))
+
+
+def execute_and_await(ctx, instance_uuids, cmds):
+    aops = submit_commands(ctx, instance_uuids, cmds)
+    await_and_reap(ctx, instance_uuids, aops)
+
+
 def instance_os_update(ctx, instance_uuids):
-    execute_and_await(
-        ctx, instance_uuids,
-        [
-            'apt-get update',
-            'apt-get dist-upgrade -y'
-        ]
-    )
+    execute_and_await(ctx, instance_uuids, [as_script(OS_UPDATE_COMMANDS)])
 
 
 def install_control_plane(ctx):
     md = get_cluster_metadata(ctx)
+    client = get_client(ctx)
     cmds = []
 
     print('Setup first control plane node')
@@ -360,20 +885,23 @@ def install_control_plane(ctx):
     cmds.append('sudo apt-get update')
     cmds.append('sudo apt-get install -y helm')
 
-    execute_and_await(ctx, [md['control_plane_nodes'][0]], cmds)
-
-    # Fetch the server and node tokens from the first control plane node
-    print('Fetching control plane registration token from first control plane node')
-    aop = ctx.obj['CLIENT'].instance_get(
-        md['control_plane_nodes'][0], '/var/lib/rancher/k3s/server/token')
-    md['server_token'] = await_fetch(ctx, aop).rstrip()
-    set_cluster_metadata(ctx, md)
-
-    print('Fetching node registration token from first control plane node')
-    aop = ctx.obj['CLIENT'].instance_get(
-        md['control_plane_nodes'][0], '/var/lib/rancher/k3s/server/node-token')
-    md['node_token'] = await_fetch(ctx, aop).rstrip()
+    execute_and_await(ctx, [md['control_plane_nodes'][0]], [as_script(cmds)])
+
+    # Fetch the server and node tokens from the first control plane node. The
+    # two fetches don't depend on each other, so both are requested before
+    # waiting for either.
+    print('Fetching control plane and node registration tokens from first '
+          'control plane node')
+    aops = [
+        client.instance_get(
+            md['control_plane_nodes'][0], '/var/lib/rancher/k3s/server/token'),
+        client.instance_get(
+            md['control_plane_nodes'][0], '/var/lib/rancher/k3s/server/node-token')
+    ]
+    md['server_token'], md['node_token'] = map_concurrently(
+        lambda aop: await_fetch(ctx, aop).rstrip(), aops)
     set_cluster_metadata(ctx, md)
+    flush_cluster_metadata(ctx)
 
     # If there is more than one control plane node, then install the others
     if len(md['control_plane_nodes']) > 1:
@@ -386,16 +914,17 @@ def install_k3s_component(ctx, instance_uuids, token, node_role):
 
     execute_and_await(
         ctx, instance_uuids,
-        [
-            'sudo apt-get update',
-            'sudo apt-get install -y',
-            (
-                'curl -sfL https://get.k3s.io | '
-                f'INSTALL_K3S_CHANNEL={md['k3s_version']} '
-                f'K3S_URL=https://{md['api_address_inner']}:6443 '
-                f'K3S_TOKEN={token} sh -s - {node_role}'
-            )
-        ]
+        [as_script(
+            [
+                'sudo apt-get update',
+                'sudo apt-get install -y',
+                (
+                    'curl -sfL https://get.k3s.io | '
+                    f'INSTALL_K3S_CHANNEL={md['k3s_version']} '
+                    f'K3S_URL=https://{md['api_address_inner']}:6443 '
+                    f'K3S_TOKEN={token} sh -s - {node_role}'
+                )
+            ])]
     )
 
     set_cluster_metadata(ctx, md)
@@ -414,50 +943,48 @@ def install_workers(ctx):
 
 def allocate_metallb_addresses(ctx, metal_address_count):
     md = get_cluster_metadata(ctx)
-    node_network = ctx.obj['CLIENT'].get_network(md['node_network'])
+    client = get_client(ctx)
+    node_network = client.get_network(md['node_network'])
 
     for i in range(metal_address_count):
-        addr = ctx.obj['CLIENT'].route_network_address(node_network['uuid'])
+        addr = client.route_network_address(node_network['uuid'])
         if addr:
             md['routed_addresses'].append(addr)
             print('Allocated routed address %s' % addr)
     print('Allocated %d routed addresses' % len(md['routed_addresses']))
     set_cluster_metadata(ctx, md)
+    flush_cluster_metadata(ctx)
 
 
-def configure_metallb_addresses(ctx):
+def metallb_address_commands(ctx):
     md = get_cluster_metadata(ctx)
 
     # Setup metallb for traffic ingress, guided by
     # https://itnext.io/kubernetes-loadbalancer-service-for-on-premises-6b7f75187be8
-    metal_lb_config = ('cat - > /etc/sf/metallb-range-allocation.yaml << EOF\n'
-                       'apiVersion: metallb.io/v1beta1\n'
-                       'kind: IPAddressPool\n'
-                       'metadata:\n'
-                       '  name: empty\n'
-                       '  namespace: metallb-system\n'
-                       'spec:\n'
-                       '  addresses:\n'
-                       '  - %s/32\n'
-                       '---\n'
-                       'apiVersion: metallb.io/v1beta1\n'
-                       'kind: L2Advertisement\n'
-                       'metadata:\n'
-                       '  name: empty\n'
-                       '  namespace: metallb-system\n'
-                       'EOF\n'
-                       % '/32\n  - '.join(md['routed_addresses']))
+    # The configuration is base64 encoded so that it reaches the node intact,
+    # whatever it contains.
+    pool = dict(METALLB_POOL_TEMPLATE)
+    pool['spec'] = {
+        'addresses': ['%s/32' % addr for addr in md['routed_addresses']]
+    }
+    metal_lb_config = yaml_dump_all([pool, METALLB_ADVERTISEMENT])
+    encoded_config = base64.b64encode(metal_lb_config.encode()).decode()
+
+    return [
+        ('kubectl wait --kubeconfig /etc/rancher/k3s/k3s.yaml -n metallb-system pod '
+         '--for=condition=Ready -l app.kubernetes.io/name=metallb --timeout=300s'),
+        'mkdir -p /etc/sf',
+        ('echo %s | base64 -d > /etc/sf/metallb-range-allocation.yaml'
+         % encoded_config),
+        'kubectl apply -f /etc/sf/metallb-range-allocation.yaml'
+    ]
 
+
+def configure_metallb_addresses(ctx):
+    md = get_cluster_metadata(ctx)
     execute_and_await(
         ctx, [md['control_plane_nodes'][0]],
-        [
-            ('kubectl wait --kubeconfig /etc/rancher/k3s/k3s.yaml -n metallb-system pod '
-             '--for=condition=Ready -l app.kubernetes.io/name=metallb --timeout=300s'),
-            'mkdir -p /etc/sf',
-            metal_lb_config,
-            'kubectl apply -f /etc/sf/metallb-range-allocation.yaml'
-        ]
-    )
+        [as_script(metallb_address_commands(ctx))])
 
 
 def setup_metallb(ctx, metal_address_count):
@@ -465,20 +992,19 @@ def setup_metallb(ctx, metal_address_count):
 
     print('Setting up metallb')
     allocate_metallb_addresses(ctx, metal_address_count)
+
+    # Install metallb, let its pods start, and then add addresses, all as a
+    # single operation on the first control plane node
     execute_and_await(
         ctx, [md['control_plane_nodes'][0]],
-        [
-            'kubectl create ns metallb-system',
-            ('KUBECONFIG=/etc/rancher/k3s/k3s.yaml helm '
-             'upgrade --install -n metallb-system metallb '
-             'oci://registry-1.docker.io/bitnamicharts/metallb'),
-        ])
-
-    # Let the metallb pods start
-    time.sleep(5)
-
-    # Add addresses
-    configure_metallb_addresses(ctx)
+        [as_script(
+            [
+                'kubectl create ns metallb-system',
+                ('KUBECONFIG=/etc/rancher/k3s/k3s.yaml helm '
+                 'upgrade --install -n metallb-system metallb '
+                 'oci://registry-1.docker.io/bitnamicharts/metallb'),
+                'sleep 5'
+            ] + metallb_address_commands(ctx))])
 
 
 def setup_longhorn(ctx):
@@ -489,19 +1015,90 @@ def setup_longhorn(ctx):
 
     execute_and_await(
         ctx, [md['control_plane_nodes'][0]],
-        [
-            'helm repo add longhorn https://charts.longhorn.io',
-            'helm repo update',
-            'kubectl create namespace longhorn-system || true',
-            (
-                'KUBECONFIG=/etc/rancher/k3s/k3s.yaml helm '
-                'install longhorn longhorn/longhorn '
-                '--namespace longhorn-system '
-                f'--version {version}'
-            ),
-            (
-                'kubectl patch storageclass local-path -p '
-                '\'{"metadata": {"annotations":{'
-                '"storageclass.kubernetes.io/is-default-class":"false"}}}\''
-            )
-        ])
+        [as_script(
+            [
+                'helm repo add longhorn https://charts.longhorn.io',
+                'helm repo update',
+                'kubectl create namespace longhorn-system || true',
+                (
+                    'KUBECONFIG=/etc/rancher/k3s/k3s.yaml helm '
+                    'install longhorn longhorn/longhorn '
+                    '--namespace longhorn-system '
+                    f'--version {version}'
+                ),
+                (
+                    'kubectl patch storageclass local-path -p '
+                    '\'{"metadata": {"annotations":{'
+                    '"storageclass.kubernetes.io/is-default-class":"false"}}}\''
+                )
+            ])])
+
+
+def _replace_file(path, data):
+    # Write to a temporary file in the same directory and rename it over the
+    # original, so that a failure part way through never leaves a truncated
+    # file behind. The data is synced before the rename so that a crash
+    # cannot leave an empty file in its place either.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _local_kubeconfig_path():
+    return os.path.join(os.path.expanduser('~'), '.kube', 'config')
+
+
+def merge_local_kubeconfig(new_kc):
+    # Add the clusters, contexts and users from new_kc to ~/.kube/config, and
+    # make its context the current one. Unlike "kubectl config view --flatten",
+    # where the existing file wins on a name clash, entries from new_kc replace
+    # existing entries with the same name. That is deliberate: a cluster which
+    # is deleted and created again under the same name has new certificates,
+    # and keeping the old entries would leave a kubeconfig which can't talk to
+    # it.
+    config_path = _local_kubeconfig_path()
+    kc = None
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            kc = yaml_load(f)
+    if not kc:
+        kc = {'apiVersion': 'v1', 'kind': 'Config', 'preferences': {}}
+
+    for section in ['clusters', 'contexts', 'users']:
+        entries = {elem.get('name'): elem for elem in kc.get(section) or []}
+        for elem in new_kc.get(section) or []:
+            entries[elem['name']] = elem
+        kc[section] = list(entries.values())
+    kc['current-context'] = new_kc['current-context']
+
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    _replace_file(config_path, yaml_dump(kc))
+
+
+def remove_local_kubeconfig(fqcn):
+    # Remove the cluster, context and user for a cluster from ~/.kube/config.
+    # This is equivalent to three "kubectl config unset" calls, but without
+    # starting kubectl three times. If the cluster was the current context
+    # then there is no longer a current context, rather than a dangling one.
+    config_path = _local_kubeconfig_path()
+    if not os.path.exists(config_path):
+        return
+
+    with open(config_path) as f:
+        kc = yaml_load(f)
+    if not kc:
+        return
+
+    for section in ['users', 'contexts', 'clusters']:
+        kc[section] = [
+            elem for elem in kc.get(section) or [] if elem.get('name') != fqcn]
+    if kc.get('current-context') == fqcn:
+        kc['current-context'] = ''
+    _replace_file(config_path, yaml_dump(kc))